@@ -1,10 +1,12 @@
 import math
+from bisect import bisect_left
 
 
 class Agent:
-    def __init__(self, pos, starting_strategy, t_aset, t_0, order_payoff, deterrent):
+    def __init__(self, pos, starting_strategy, t_aset, t_0, order_payoff, deterrent, start_time=0):
         """Create new agent"""
         self._pos, self._strategy, self._last_strategy = pos, starting_strategy, starting_strategy
+        self._start_time = start_time
         self._distance_to_exit = 0
         self._t_aset, self._t0, self._order_payoff, self._deterrent = t_aset, t_0, order_payoff, deterrent
         # Dictionary that returns the cost of each types, if both patient or impatient this must be calculated at runtime
@@ -22,6 +24,10 @@ class Agent:
         """Accessor method"""
         return self._pos
 
+    def get_start_time(self):
+        """Accessor method"""
+        return self._start_time
+
     def get_strategy(self):
         """Accessor method"""
         return self._last_strategy
@@ -46,6 +52,10 @@ class Agent:
                 agents_closer_to_exit += 1
         self._t_i = agents_closer_to_exit / exit_capacity
 
+    def update_t_i_from_sorted(self, sorted_distances, exit_capacity):
+        """Updates value of ti using a sorted list of every agent's distance to the exit"""
+        self._t_i = bisect_left(sorted_distances, self._distance_to_exit) / exit_capacity
+
     def get_t_i(self):
         """Accessor method"""
         return self._t_i
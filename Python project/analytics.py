@@ -0,0 +1,117 @@
+import numpy as np
+from utilities import STRATEGIES
+
+
+class EvacuationAnalytics:
+    def __init__(self, grid_size, exit_pos, density_bins=20, capacity=256):
+        """Creates streaming evacuation metrics, updated as the simulation runs instead of from stored trajectories"""
+        self._grid_size, self._exit_pos = grid_size, exit_pos
+        self._steps = 0
+        # Per move step series, grown by doubling when full
+        self._step_time = np.zeros(capacity, dtype=np.int64)
+        self._throughput = np.zeros(capacity, dtype=np.int64)
+        self._queue_length = np.zeros(capacity, dtype=np.int64)
+        self._contention_losses = np.zeros(capacity, dtype=np.int64)
+        # Heatmaps indexed [y][x] like the grid, density is summed agent occupancy and visits counts agents moving in
+        # Occupancy is only added when an agent leaves a cell, using the move step it arrived at (-1 for empty cells)
+        self._density_heatmap = np.zeros((grid_size[1], grid_size[0]), dtype=np.int64)
+        self._occupied_since = np.full((grid_size[1], grid_size[0]), -1, dtype=np.int64)
+        self._steps_started, self._agent_count = 0, 0
+        self._visit_heatmap = np.zeros((grid_size[1], grid_size[0]), dtype=np.int64)
+        # Per strategy totals, in the order of STRATEGIES
+        self._exits_by_strategy = np.zeros(len(STRATEGIES), dtype=np.int64)
+        self._evacuation_time_by_strategy = np.zeros(len(STRATEGIES))
+        self._contention_losses_by_strategy = np.zeros(len(STRATEGIES), dtype=np.int64)
+        # Fundamental diagram, flow summed into bins of density between 0 and 1
+        self._density_bins = density_bins
+        self._flow_sum = np.zeros(density_bins)
+        self._flow_count = np.zeros(density_bins, dtype=np.int64)
+        # Counts for the move step in progress
+        self._agents_in_step, self._moves_in_step = 0, 0
+
+    def start_move_step(self, time, queue_length):
+        """Called before agents move, every agent on the grid counts as occupying its cell for this step"""
+        if self._steps == len(self._throughput):
+            for name in ('_step_time', '_throughput', '_queue_length', '_contention_losses'):
+                series = getattr(self, name)
+                setattr(self, name, np.concatenate((series, np.zeros_like(series))))
+        self._step_time[self._steps] = time
+        self._queue_length[self._steps] = queue_length
+        self._agents_in_step, self._moves_in_step = self._agent_count, 0
+        self._steps_started += 1
+
+    def record_agent_added(self, pos):
+        """Called when an agent is placed on the grid"""
+        self._occupied_since[pos[1], pos[0]] = self._steps_started
+        self._agent_count += 1
+
+    def record_agent_removed(self, pos):
+        """Called when an agent is taken off the grid, adds the steps it spent in its cell to the density heatmap"""
+        self._density_heatmap[pos[1], pos[0]] += self._steps_started - self._occupied_since[pos[1], pos[0]]
+        self._occupied_since[pos[1], pos[0]] = -1
+        self._agent_count -= 1
+
+    def record_move(self, old_pos, pos):
+        """Called when an agent moves from one cell into another, including the exit"""
+        self._visit_heatmap[pos[1], pos[0]] += 1
+        self._moves_in_step += 1
+        self.record_agent_removed(old_pos)
+        if pos != self._exit_pos:
+            self.record_agent_added(pos)
+
+    def record_exit(self, strategy, evacuation_time):
+        """Called when an agent leaves through the exit"""
+        self._throughput[self._steps] += 1
+        self._exits_by_strategy[STRATEGIES.index(strategy)] += 1
+        self._evacuation_time_by_strategy[STRATEGIES.index(strategy)] += evacuation_time
+
+    def record_contention_loss(self, strategy):
+        """Called when an agent loses a contested move and stays where it is"""
+        self._contention_losses[self._steps] += 1
+        self._contention_losses_by_strategy[STRATEGIES.index(strategy)] += 1
+
+    def end_move_step(self, open_cells):
+        """Called after agents move, adds the step to the fundamental diagram"""
+        if open_cells > 0:
+            density = self._agents_in_step / open_cells
+            density_bin = min(int(density * self._density_bins), self._density_bins - 1)
+            self._flow_sum[density_bin] += self._moves_in_step / open_cells
+            self._flow_count[density_bin] += 1
+        self._steps += 1
+
+    def get_step_times(self):
+        """Time step each move step happened at"""
+        return self._step_time[:self._steps].copy()
+
+    def get_throughput(self):
+        """Agents leaving through the exit on each move step"""
+        return self._throughput[:self._steps].copy()
+
+    def get_queue_length(self):
+        """Agents waiting in the Moore neighbourhood of the exit at the start of each move step"""
+        return self._queue_length[:self._steps].copy()
+
+    def get_contention_losses(self):
+        """Agents that lost a contested move on each move step, and totals for each strategy"""
+        return self._contention_losses[:self._steps].copy(), dict(zip(STRATEGIES, self._contention_losses_by_strategy.tolist()))
+
+    def get_density_heatmap(self):
+        """Fraction of move steps each cell was occupied by an agent"""
+        # Agents still on the grid have not been added yet, so add the steps since they arrived
+        current = np.where(self._occupied_since >= 0, self._steps_started - self._occupied_since, 0)
+        return (self._density_heatmap + current) / max(self._steps, 1)
+
+    def get_visit_heatmap(self):
+        """Number of times an agent moved into each cell"""
+        return self._visit_heatmap.copy()
+
+    def get_mean_evacuation_times(self):
+        """Mean time from being added to leaving for each strategy, nan if no agents of that strategy have left"""
+        means = np.divide(self._evacuation_time_by_strategy, self._exits_by_strategy, out=np.full(len(STRATEGIES), np.nan), where=self._exits_by_strategy > 0)
+        return dict(zip(STRATEGIES, means.tolist()))
+
+    def get_fundamental_diagram(self):
+        """Density bin centres, mean flow (moves per open cell per step) in each bin and how many steps fell in each bin"""
+        centres = (np.arange(self._density_bins) + 0.5) / self._density_bins
+        mean_flow = np.divide(self._flow_sum, self._flow_count, out=np.full(self._density_bins, np.nan), where=self._flow_count > 0)
+        return centres, mean_flow, self._flow_count.copy()
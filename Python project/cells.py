@@ -1,3 +1,4 @@
+"""This file is deprecated, cell values are now stored as arrays in SpatialDynamics so large grids can be created quickly"""
 import math
 from utilities import *
 
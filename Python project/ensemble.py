@@ -0,0 +1,281 @@
+import numpy as np
+from utilities import STRATEGIES
+
+# Strategies are stored as indices into STRATEGIES so replicas can be held in arrays
+PATIENT, IMPATIENT, NEUTRAL = 0, 1, 2
+# Moore neighbourhood offsets (x, y), in the same order the single simulation loops through them
+MOORE_NEIGHBOURHOOD = [(x, y) for y in range(-1, 2) for x in range(-1, 2)]
+
+
+def find_keys(sorted_keys, keys):
+    """Returns where each key is in a sorted array of keys, -1 for keys that are not in it"""
+    if len(sorted_keys) == 0:
+        return np.full(np.shape(keys), -1)
+    index = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(sorted_keys[index] == keys, index, -1)
+
+
+def key_ranges(sorted_keys, starts, ends):
+    """Returns the index of every key between each start and end, and which range each one belongs to"""
+    low, high = np.searchsorted(sorted_keys, starts), np.searchsorted(sorted_keys, ends)
+    lengths = high - low
+    owner = np.repeat(np.arange(len(starts)), lengths)
+    index = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(low, lengths)
+    return index, owner
+
+
+class Ensemble:
+    def __init__(self, replicas, walls, sf, df, agent_positions, agent_strategies, exit_pos, exit_capacity, cost_of_congestion, df_diffuse_rate, df_increase, df_strength, sf_strength, t_aset, t_0, order_payoff, repeat_deterrent, seed=None):
+        """Creates many independent replicas of one layout, all replicas are stored in stacked arrays and advanced together"""
+        # Model parameters, same meaning as in SpatialDynamics
+        self._c, self._df_diffuse_rate, self._df_increase, self._df_strength, self._sf_strength = cost_of_congestion, df_diffuse_rate, df_increase, df_strength, sf_strength
+        self._t_aset, self._t_0, self._order_payoff, self._repeat_deterrent = t_aset, t_0, order_payoff, repeat_deterrent
+        self._exit_pos, self._exit_capacity = exit_pos, exit_capacity
+        self._rng = np.random.default_rng(seed)
+        # Layout shared by every replica, walls do not change while running (H x W)
+        self._walls = np.asarray(walls, dtype=bool)
+        self._sf = np.asarray(sf, dtype=float)
+        self._height, self._width = self._walls.shape
+        self._exit_index = exit_pos[1] * self._width + exit_pos[0]
+        # Per replica fields (K x H x W)
+        self._replicas = replicas
+        self._df = np.repeat(np.asarray(df, dtype=float)[np.newaxis], replicas, axis=0)
+        # Per replica agent arrays (K x N), agents that have left through the exit are inactive
+        agent_count = len(agent_positions)
+        positions = np.asarray(agent_positions, dtype=np.int64).reshape(agent_count, 2)
+        self._x = np.repeat(positions[np.newaxis, :, 0], replicas, axis=0)
+        self._y = np.repeat(positions[np.newaxis, :, 1], replicas, axis=0)
+        self._strategy = np.repeat(np.array([STRATEGIES.index(s) for s in agent_strategies], dtype=np.int8)[np.newaxis], replicas, axis=0)
+        self._active = np.ones((replicas, agent_count), dtype=bool)
+        self._t_i = np.zeros((replicas, agent_count))
+        # Number of cells on each agent's route, including where they started
+        self._route_length = np.ones((replicas, agent_count), dtype=np.int64)
+        # Cells each agent has visited as sorted keys, so the deterrent is a binary search
+        # Each key stores how many times it was visited and the sum of its positions along the route, which is all the df trail needs
+        # New keys are kept in a small table of their own and merged in once it grows, rather than inserted every step
+        k, n = np.nonzero(self._active)
+        self._visited_keys = np.sort(self._agent_key(k, n) + self._y[k, n] * self._width + self._x[k, n])
+        self._visited_counts = np.ones(len(self._visited_keys), dtype=np.int64)
+        self._visited_positions = np.ones(len(self._visited_keys), dtype=np.int64)
+        self._new_keys = np.zeros(0, dtype=np.int64)
+        self._new_counts, self._new_positions = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # Replica index for every agent, used for gathering from K x H x W fields
+        self._replica_index = np.repeat(np.arange(replicas)[:, np.newaxis], agent_count, axis=1)
+        # Results
+        self._time = np.zeros(replicas, dtype=np.int64)
+        self._evacuation_time = np.full(replicas, np.nan)
+        self._patient_distribution, self._impatient_distribution, self._neutral_distribution = [], [], []
+        self._move = False
+
+    def _agent_key(self, k, n):
+        """Offset for an agent's visited cell keys, unique to each agent in each replica"""
+        return (k * self._x.shape[1] + n) * self._height * self._width
+
+    def _running(self):
+        """Returns which replicas still have agents in them"""
+        return self._active.any(axis=1)
+
+    def _update_agent_strategies(self):
+        """Updates every agent's strategy in every replica"""
+        running = self._running()
+        active = self._active
+        # Distance to the exit, inactive agents are pushed past every real distance so they are never counted as closer
+        distance = np.sqrt((self._x - self._exit_pos[0]) ** 2.0 + (self._y - self._exit_pos[1]) ** 2.0)
+        beyond = np.sqrt(float(self._height ** 2 + self._width ** 2)) + 1
+        distance = np.where(active, distance, beyond)
+        # t_i is the number of agents closer to the exit, offsetting each replica lets one sorted search serve them all
+        offset = (np.arange(self._replicas) * (beyond + 1))[:, np.newaxis]
+        sorted_distance = (np.sort(distance, axis=1) + offset).ravel()
+        closer = np.searchsorted(sorted_distance, (distance + offset).ravel(), side='left').reshape(distance.shape)
+        self._t_i = (closer - np.arange(self._replicas)[:, np.newaxis] * distance.shape[1]) / self._exit_capacity
+
+        # Strategy and t_i of whoever is in each cell, -1 strategy means the cell has no agent
+        strategy_grid = np.full((self._replicas, self._height, self._width), -1, dtype=np.int8)
+        t_i_grid = np.zeros((self._replicas, self._height, self._width))
+        k, x, y = self._replica_index[active], self._x[active], self._y[active]
+        strategy_grid[k, y, x] = self._strategy[active]
+        t_i_grid[k, y, x] = self._t_i[active]
+
+        # Sum the cost of each strategy against every agent in the Moore neighbourhood
+        sum_patient, sum_impatient = np.zeros(self._t_i.shape), np.zeros(self._t_i.shape)
+        for x2, y2 in MOORE_NEIGHBOURHOOD:
+            if (x2, y2) == (0, 0):
+                continue
+            neighbour_strategy = strategy_grid[self._replica_index, self._y + y2, self._x + x2]
+            t_ij = (self._t_i + t_i_grid[self._replica_index, self._y + y2, self._x + x2]) / 2
+            delta_u = np.where(t_ij < self._t_aset - self._t_0, 0, (self._c / self._t_0) * (t_ij - self._t_aset + self._t_0))
+            has_delta_u = delta_u != 0
+            pp_cost = np.divide(-self._order_payoff, delta_u, out=np.zeros_like(delta_u), where=has_delta_u)
+            ii_cost = np.divide(self._c, delta_u, out=np.zeros_like(delta_u), where=has_delta_u)
+            sum_patient += np.where(neighbour_strategy == IMPATIENT, 1, np.where(neighbour_strategy == PATIENT, pp_cost, 0))
+            sum_impatient += np.where(neighbour_strategy == PATIENT, -1, np.where(neighbour_strategy == IMPATIENT, ii_cost, 0))
+        # Cost to be neutral is always 0
+        sum_neutral = np.zeros(self._t_i.shape)
+
+        # If no clear strategy, stay with current strategy, otherwise choose lowest cost (Patient > Impatient > Neutral on ties)
+        lowest_cost = np.minimum(np.minimum(sum_patient, sum_impatient), sum_neutral)
+        new_strategy = np.where(sum_patient == lowest_cost, PATIENT, np.where(sum_impatient == lowest_cost, IMPATIENT, NEUTRAL))
+        undecided = (sum_patient == sum_impatient) & (sum_impatient == sum_neutral)
+        self._strategy = np.where(active & ~undecided, new_strategy, self._strategy).astype(np.int8)
+
+        # Save agents distribution for every replica that is still running, finished replicas are recorded as nan
+        agent_count = active.sum(axis=1)
+        distributions = []
+        for strategy in (PATIENT, IMPATIENT, NEUTRAL):
+            count = (active & (self._strategy == strategy)).sum(axis=1)
+            distributions.append(np.where(running, count / np.maximum(agent_count, 1), np.nan))
+        self._patient_distribution.append(distributions[0])
+        self._impatient_distribution.append(distributions[1])
+        self._neutral_distribution.append(distributions[2])
+        self._time += running
+
+    def _route_visits(self, agent_keys):
+        """Returns how many times each agent has been to each cell, keys are agent key + cell index"""
+        visits = np.zeros(np.shape(agent_keys), dtype=np.int64)
+        for keys, counts in ((self._visited_keys, self._visited_counts), (self._new_keys, self._new_counts)):
+            index = find_keys(keys, agent_keys)
+            visits[index >= 0] = counts[index[index >= 0]]
+        return visits
+
+    def _add_route_visits(self, agent_keys, positions):
+        """Counts a visit for each key at the given position along the route, keys are unique as every agent moves at most once per step"""
+        for keys, counts, visited_positions in ((self._visited_keys, self._visited_counts, self._visited_positions), (self._new_keys, self._new_counts, self._new_positions)):
+            index = find_keys(keys, agent_keys)
+            found = index >= 0
+            counts[index[found]] += 1
+            visited_positions[index[found]] += positions[found]
+            agent_keys, positions = agent_keys[~found], positions[~found]
+        # Keys visited for the first time go in the small table of new keys
+        order = np.argsort(agent_keys)
+        index = np.searchsorted(self._new_keys, agent_keys[order])
+        self._new_keys = np.insert(self._new_keys, index, agent_keys[order])
+        self._new_counts = np.insert(self._new_counts, index, 1)
+        self._new_positions = np.insert(self._new_positions, index, positions[order])
+
+    def _merge_route_visits(self):
+        """Merges the new keys into the main table once there are enough of them, dropping agents that have left"""
+        if len(self._new_keys) < max(1024, len(self._visited_keys) // 8):
+            return
+        keys = np.concatenate((self._visited_keys, self._new_keys))
+        counts = np.concatenate((self._visited_counts, self._new_counts))
+        positions = np.concatenate((self._visited_positions, self._new_positions))
+        agent = keys // (self._height * self._width)
+        keep = self._active.ravel()[agent]
+        order = np.argsort(keys[keep], kind='stable')
+        self._visited_keys, self._visited_counts, self._visited_positions = keys[keep][order], counts[keep][order], positions[keep][order]
+        self._new_keys = np.zeros(0, dtype=np.int64)
+        self._new_counts, self._new_positions = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    def _move_agents(self):
+        """Moves agents in every replica using the probability based model"""
+        # Only agents still in the grid are considered, as flat lists of (replica, agent) pairs
+        k, n = np.nonzero(self._active)
+        x, y = self._x[k, n], self._y[k, n]
+        strategy = self._strategy[k, n]
+        occupied = np.repeat(self._walls[np.newaxis], self._replicas, axis=0)
+        occupied[k, y, x] = True
+
+        # Calculate probability to move to each cell in the Moore neighbourhood (agents x 9)
+        candidate_x = x[:, np.newaxis] + np.array([x2 for x2, _ in MOORE_NEIGHBOURHOOD])
+        candidate_y = y[:, np.newaxis] + np.array([y2 for _, y2 in MOORE_NEIGHBOURHOOD])
+        replica_index = k[:, np.newaxis]
+        # Impatient agents weight sf more heavily and neutral agents weight df more heavily
+        sf_multiplier = np.where(strategy == IMPATIENT, 10, 1)[:, np.newaxis]
+        df_multiplier = np.where(strategy == NEUTRAL, 10, 1)[:, np.newaxis]
+        probability = np.exp(self._df[replica_index, candidate_y, candidate_x] * self._df_strength * df_multiplier) * np.exp(self._sf[candidate_y, candidate_x] * self._sf_strength * sf_multiplier)
+        probability *= ~occupied[replica_index, candidate_y, candidate_x]
+        # Apply deterrent to moves the agent has made already, halved on every repeat visit
+        candidates = candidate_y * self._width + candidate_x
+        visits = self._route_visits(self._agent_key(k, n)[:, np.newaxis] + candidates)
+        probability *= np.where(visits > 0, self._repeat_deterrent * 0.5 ** np.maximum(visits - 1, 0), 1)
+
+        # Choose a move for every agent with somewhere to go, sampled from the cumulative probabilities
+        cumulative = np.cumsum(probability, axis=1)
+        total = cumulative[:, -1]
+        threshold = self._rng.random(len(total)) * total
+        choice = np.minimum((cumulative <= threshold[:, np.newaxis]).sum(axis=1), len(MOORE_NEIGHBOURHOOD) - 1)
+        movers = total > 0
+        if not movers.any():
+            return
+        k, n = k[movers], n[movers]
+        target = candidates[movers, choice[movers]]
+
+        # Resolve contention, priority order is Impatient > Patient > Neutral, random between agents of the same priority
+        priority = np.array([1, 0, 2])[self._strategy[k, n]]
+        contested_cell = k * self._height * self._width + target
+        order = np.lexsort((self._rng.random(len(k)), priority, contested_cell))
+        k, n, target, contested_cell = k[order], n[order], target[order], contested_cell[order]
+        group_start = np.ones(len(k), dtype=bool)
+        group_start[1:] = contested_cell[1:] != contested_cell[:-1]
+        start_index = np.maximum.accumulate(np.where(group_start, np.arange(len(k)), 0))
+        # Normal cells can fit one agent, exit door can fit as many as specified by exit capacity
+        space_available = np.where(target == self._exit_index, self._exit_capacity, 1)
+        chosen = (np.arange(len(k)) - start_index) < space_available
+        k, n, target = k[chosen], n[chosen], target[chosen]
+
+        # Move the chosen agents and add the move to their route
+        self._x[k, n], self._y[k, n] = target % self._width, target // self._width
+        self._route_length[k, n] += 1
+        self._add_route_visits(self._agent_key(k, n) + target, self._route_length[k, n])
+
+        # Agents that reached the exit leave and add their df trail, weighted by how recently they were at each cell
+        leaving = target == self._exit_index
+        if leaving.any():
+            k, n = k[leaving], n[leaving]
+            self._active[k, n] = False
+            # Each visit adds df_increase * position along the route / route length, so a cell's total uses the sum of its positions
+            cells_per_grid = self._height * self._width
+            starts = self._agent_key(k, n)
+            df = self._df.reshape(-1)
+            for keys, visited_positions in ((self._visited_keys, self._visited_positions), (self._new_keys, self._new_positions)):
+                index, owner = key_ranges(keys, starts, starts + cells_per_grid)
+                cells = k[owner] * cells_per_grid + keys[index] % cells_per_grid
+                np.add.at(df, cells, self._df_increase * visited_positions[index] / self._route_length[k[owner], n[owner]])
+            np.minimum(df, 1, out=df)
+            # Replicas whose last agent has just left record their evacuation time
+            finished = ~self._running() & np.isnan(self._evacuation_time)
+            self._evacuation_time[finished] = self._time[finished]
+        self._merge_route_visits()
+
+    def _diffuse_df(self, replicas):
+        """Diffuses df values for each cell to neighbouring cells, for the given replicas"""
+        df = self._df[replicas]
+        diffuse_rate = np.where(self._walls, 0, np.minimum(df, self._df_diffuse_rate))
+        spread = np.pad(diffuse_rate / 8, ((0, 0), (1, 1), (1, 1)))
+        change = -diffuse_rate
+        for x2, y2 in MOORE_NEIGHBOURHOOD:
+            if (x2, y2) != (0, 0):
+                change += spread[:, 1 + y2:1 + y2 + self._height, 1 + x2:1 + x2 + self._width]
+        self._df[replicas] = np.clip(df + change, 0, 1)
+
+    def run_one_step(self):
+        """Updates agent strategies or moves them in every running replica, alternating each time it is called"""
+        running = self._running()
+        if running.any():
+            if not self._move:
+                self._update_agent_strategies()
+            else:
+                self._move_agents()
+                self._diffuse_df(running)
+            self._move = not self._move
+
+    def run(self, max_steps=None):
+        """Runs until every replica is empty or max_steps time steps have passed, returns the evacuation times"""
+        while self._running().any() and (max_steps is None or self._time.max() < max_steps or self._move):
+            self.run_one_step()
+        return self.get_evacuation_times()
+
+    def get_evacuation_times(self):
+        """Time step each replica's last agent left at, nan if agents remain"""
+        return self._evacuation_time.copy()
+
+    def get_agents_remaining(self):
+        """Number of agents still in each replica"""
+        return self._active.sum(axis=1)
+
+    def get_distributions(self):
+        """Patient, impatient and neutral distributions, each a replicas x time steps array"""
+        distributions = []
+        for distribution in (self._patient_distribution, self._impatient_distribution, self._neutral_distribution):
+            distributions.append(np.array(distribution).T if distribution else np.zeros((self._replicas, 0)))
+        return tuple(distributions)
@@ -1,8 +1,9 @@
-import pygame as pg
 from agents import Agent
-from cells import Cell
+from ensemble import Ensemble
+from analytics import EvacuationAnalytics
+from pathfinding import FlowField
+from rendering import FrameRenderer, GifWriter, VideoWriter
 from utilities import *
-import matplotlib.pyplot as plt
 import numpy as np
 import random
 import math
@@ -10,7 +11,7 @@ import time
 
 
 class SpatialDynamics:
-    def __init__(self, grid_size, cell_size, exit_pos, exit_capacity, cost_of_congestion, df_diffuse_rate, df_increase, df_strength, sf_strength, t_aset, t_0, order_payoff, repeat_deterrent, auto_scale_sf=False, show_probs=True):
+    def __init__(self, grid_size, cell_size, exit_pos, exit_capacity, cost_of_congestion, df_diffuse_rate, df_increase, df_strength, sf_strength, t_aset, t_0, order_payoff, repeat_deterrent, auto_scale_sf=False, show_probs=True, incremental_strategies=True, save_plots=True, route_bias=0):
         """Creates the simulation"""
         # Model parameters
         self._c, self._df_diffuse_rate, self._df_increase, self._df_strength, self._sf_strength = cost_of_congestion, df_diffuse_rate, df_increase, df_strength, sf_strength
@@ -18,55 +19,146 @@ class SpatialDynamics:
         self._window, self._mouse_button_down = None, None
         self._auto_run, self._running, self._move = False, False, False
         self._exit_pos = (exit_pos[0] + 1, exit_pos[1] + 1)
-        self._exit_capacity, self._cell_size, self._show_probs = exit_capacity, cell_size, show_probs
+        self._exit_capacity, self._cell_size, self._show_probs, self._save_plots = exit_capacity, cell_size, show_probs, save_plots
         self._grid_size = (grid_size[0] + 2, grid_size[1] + 2)
         self._auto_run_delay = 0.5
         # Core variables used in simulation
-        self._agents, self._grid, self._patient_distribution, self._impatient_distribution, self._neutral_distribution = [], [], [], [], []
+        self._agents, self._patient_distribution, self._impatient_distribution, self._neutral_distribution = [], [], [], []
         self._time = 0
         self._t_aset, self._t_0, self._order_payoff, self._repeat_deterrent = t_aset, t_0, order_payoff, repeat_deterrent
-        # Create grid after initialisation
+        # Incremental strategies finds t_i and neighbours with a sorted search and a position lookup instead of comparing every pair of agents
+        # Setting incremental strategies to False uses the original pairwise comparisons, useful for validation
+        self._incremental_strategies = incremental_strategies
+        # Create grid after initialisation, cell values are stored as arrays indexed [y][x]
+        self._sf, self._df, self._walls, self._borders, self._occupied = None, None, None, None, None
         self._create_grid()
+        # Evacuation metrics updated as the simulation runs, open cells is recounted only after walls change
+        self._analytics, self._open_cells = EvacuationAnalytics(self._grid_size, self._exit_pos), None
+        # Route bias makes agents more likely to take the next cell on the shortest route to the exit, the flow field is only created when needed
+        self._route_bias, self._flow_field = route_bias, None
+        # Draws frames without a window, only created when needed
+        self._renderer = None
         # Scales sf and df to match grid size, on larger grids keeping these at 1 makes probability difference minimal so agents get stuck
         if auto_scale_sf:
             multi = grid_size[0] + grid_size[1]
             self._df_strength, self._sf_strength = multi, multi
 
-    def fill_grid_random(self, patient_weight, impatient_weight, neutral_weight):
+    def fill_grid_random(self, patient_weight, impatient_weight, neutral_weight, seed=None):
         """Optional method that fills the grid with agents, random but weighted"""
-        for x in range(self._grid_size[0]):
-            for y in range(self._grid_size[1]):
-                if (x, y) != self._exit_pos:
-                    choice = random.choices(['p', 'i', 'n', None], [patient_weight, impatient_weight, neutral_weight, 1 - patient_weight - impatient_weight - neutral_weight])[0]
-                    if choice is not None:
-                        self._add_agent((x, y), choice)
+        self.populate(strategy_weights=(patient_weight, impatient_weight, neutral_weight), seed=seed)
+
+    def populate(self, strategy_weights=(0, 0, 0), density=None, strategy_probabilities=None, walls=None, seed=None):
+        """Fills empty cells with agents and walls in one pass, arrays cover the grid without its border and are indexed [y][x]
+        strategy_weights gives the chance of each empty cell getting a patient, impatient or neutral agent
+        density gives a per cell chance of an agent instead, with strategy_probabilities (height x width x 3) choosing their strategy
+        walls is a boolean array of cells to turn into walls, these are added before the agents"""
+        interior_shape = (self._grid_size[1] - 2, self._grid_size[0] - 2)
+        for array in (density, strategy_probabilities, walls):
+            if array is not None and np.shape(array)[:2] != interior_shape:
+                print(f'Error populating grid, arrays must be {interior_shape[0]} x {interior_shape[1]} to match the grid.')
+                return False
+        if strategy_probabilities is not None and (np.ndim(strategy_probabilities) != 3 or np.shape(strategy_probabilities)[2] != 3):
+            print('Error populating grid, strategy probabilities must have 3 values (patient, impatient, neutral) per cell.')
+            return False
+        if density is None:
+            density = np.full(interior_shape, float(sum(strategy_weights)))
+        if strategy_probabilities is None:
+            strategy_probabilities = np.broadcast_to(np.asarray(strategy_weights, dtype=float), interior_shape + (3,))
+        # Every cell that can get an agent needs a strategy to choose from, otherwise they would all silently become neutral
+        if np.any((np.asarray(density) > 0) & (np.sum(strategy_probabilities, axis=2) <= 0)):
+            print('Error populating grid, a density was given without any non-zero strategy weights or probabilities for those cells.')
+            return False
+        rng = np.random.default_rng(seed)
+        if walls is not None:
+            new_walls = np.asarray(walls, dtype=bool) & ~self._occupied[1:-1, 1:-1]
+            new_walls[self._exit_pos[1] - 1, self._exit_pos[0] - 1] = False
+            self._walls[1:-1, 1:-1] |= new_walls
+            self._occupied[1:-1, 1:-1] |= new_walls
+            self._walls_changed([(int(x) + 1, int(y) + 1) for y, x in zip(*np.nonzero(new_walls))])
+        # Only empty cells that are not the exit can be given agents
+        free = ~self._occupied[1:-1, 1:-1]
+        free[self._exit_pos[1] - 1, self._exit_pos[0] - 1] = False
+        # Choose which cells get an agent, then choose each agent's strategy from the cumulative probabilities
+        placed = free & (rng.random(interior_shape) < density)
+        cumulative = np.cumsum(strategy_probabilities, axis=2)
+        threshold = rng.random(interior_shape) * cumulative[:, :, -1]
+        choice = np.minimum((cumulative <= threshold[:, :, np.newaxis]).sum(axis=2), 2)
+        for y, x in zip(*np.nonzero(placed)):
+            pos = (int(x) + 1, int(y) + 1)
+            self._agents.append(Agent(pos, STRATEGIES[choice[y, x]], self._t_aset, self._t_0, self._order_payoff, self._repeat_deterrent, self._time))
+            self._analytics.record_agent_added(pos)
+        self._occupied[1:-1, 1:-1] |= placed
+        return True
+
+    def load_floor_plan(self, path, seed=None):
+        """Loads walls and agents from an image the same size as the grid (without its border), one pixel per cell
+        Black pixels are walls, blue are patient agents, red are impatient agents, green are neutral agents and anything else is empty"""
+        import matplotlib.pyplot as plt
+        image = plt.imread(path)
+        if image.dtype == np.uint8:
+            image = image / 255
+        if image.ndim == 2:
+            image = np.stack((image, image, image), axis=2)
+        red, green, blue = image[:, :, 0], image[:, :, 1], image[:, :, 2]
+        walls = (red < 0.25) & (green < 0.25) & (blue < 0.25)
+        strategy_probabilities = np.stack((
+            (blue >= 0.5) & (red < 0.5) & (green < 0.5),
+            (red >= 0.5) & (green < 0.5) & (blue < 0.5),
+            (green >= 0.5) & (red < 0.5) & (blue < 0.5)
+        ), axis=2).astype(float)
+        return self.populate(density=strategy_probabilities.sum(axis=2), strategy_probabilities=strategy_probabilities, walls=walls, seed=seed)
+
+    def create_ensemble(self, replicas, seed=None):
+        """Creates an ensemble of independent replicas of the current layout, advanced together for statistical studies"""
+        return Ensemble(
+            replicas=replicas,
+            walls=self._walls,
+            sf=self._sf,
+            df=self._df,
+            agent_positions=[agent.get_pos() for agent in self._agents],
+            agent_strategies=[agent.get_strategy() for agent in self._agents],
+            exit_pos=self._exit_pos,
+            exit_capacity=self._exit_capacity,
+            cost_of_congestion=self._c,
+            df_diffuse_rate=self._df_diffuse_rate,
+            df_increase=self._df_increase,
+            df_strength=self._df_strength,
+            sf_strength=self._sf_strength,
+            t_aset=self._t_aset,
+            t_0=self._t_0,
+            order_payoff=self._order_payoff,
+            repeat_deterrent=self._repeat_deterrent,
+            seed=seed
+        )
 
     def _create_grid(self):
-        """Creates the grid, 2D array of cell instances"""
-        for y in range(self._grid_size[1]):
-            row = []
-            for x in range(self._grid_size[0]):
-                if x == 0 or y == 0 or x == self._grid_size[0] - 1 or y == self._grid_size[1] - 1:
-                    row.append(Cell((x, y), self._grid_size, self._exit_pos, True, True))
-                else:
-                    row.append(Cell((x, y), self._grid_size, self._exit_pos))
-            self._grid.append(row)
-        print('\nGrid sf values:')
-        for row in self._grid:
-            for column in row:
-                if not column.is_wall():
-                    print('%.3f' % column.get_sf(), end=' | ')
-            print()
+        """Creates the grid, sf values are based on distance to the exit between 1 and 0 and the outer ring of cells is a border wall"""
+        x = np.arange(self._grid_size[0])[np.newaxis, :]
+        y = np.arange(self._grid_size[1])[:, np.newaxis]
+        distance_to_exit = np.sqrt((x - self._exit_pos[0]) ** 2 + (y - self._exit_pos[1]) ** 2)
+        max_distance = largest([
+            math.sqrt(((self._grid_size[0] - self._exit_pos[0]) ** 2) + ((self._grid_size[1] - self._exit_pos[1]) ** 2)),
+            math.sqrt((self._exit_pos[0] ** 2) + (self._exit_pos[1] ** 2)),
+            math.sqrt(((self._grid_size[0] - self._exit_pos[0]) ** 2) + (self._exit_pos[1] ** 2)),
+            math.sqrt((self._exit_pos[0] ** 2) + ((self._grid_size[1] - self._exit_pos[1]) ** 2))
+        ])
+        self._sf = 1 - (distance_to_exit / max_distance)
+        self._df = np.zeros((self._grid_size[1], self._grid_size[0]))
+        self._borders = np.ones((self._grid_size[1], self._grid_size[0]), dtype=bool)
+        self._borders[1:-1, 1:-1] = False
+        # Walls are always occupied, so agents can never move into them
+        self._walls, self._occupied = self._borders.copy(), self._borders.copy()
 
     def _add_agent(self, pos, strategy):
         """Adds an agent to the grid if it is within the bounds and there is nothing at that position already"""
         if strategy in ['p', 'i', 'n'] and 0 <= pos[0] <= self._grid_size[0] - 1 and 0 <= pos[1] <= self._grid_size[1] - 1:
-            space_taken = self._grid[pos[1]][pos[0]].get_occupied_multiplier()
+            space_taken = self._occupied[pos[1], pos[0]]
             if not space_taken:
-                self._agents.append(Agent(pos, strategy, self._t_aset, self._t_0, self._order_payoff, self._repeat_deterrent))
-                self._grid[pos[1]][pos[0]].set_occupied(True)
+                self._agents.append(Agent(pos, strategy, self._t_aset, self._t_0, self._order_payoff, self._repeat_deterrent, self._time))
+                self._occupied[pos[1], pos[0]] = True
+                self._analytics.record_agent_added(pos)
                 return True
-            if not self._grid[pos[1]][pos[0]].is_wall():
+            if not self._walls[pos[1], pos[0]]:
                 for i in range(len(self._agents)):
                     if self._agents[i].get_pos() == pos:
                         self._agents[i].toggle_strategy()
@@ -76,20 +168,36 @@ class SpatialDynamics:
     def _add_wall(self, pos):
         """Adds a wall to the grid if it is within the bounds and there is nothing at that position already"""
         if 0 <= pos[0] <= self._grid_size[0]-1 and 0 <= pos[1] <= self._grid_size[1]-1:
-            space_taken = self._grid[pos[1]][pos[0]].get_occupied_multiplier()
+            space_taken = self._occupied[pos[1], pos[0]]
             if not space_taken:
-                self._grid[pos[1]][pos[0]].add_wall()
+                self._walls[pos[1], pos[0]], self._occupied[pos[1], pos[0]] = True, True
+                self._walls_changed([pos])
                 return True
         return False
 
+    def _walls_changed(self, positions):
+        """Called after walls are added or removed, so anything calculated from the walls is updated"""
+        self._open_cells = None
+        if self._flow_field is not None:
+            self._flow_field.update_cells(self._walls, positions)
+
+    def _get_next_hop(self, pos):
+        """Returns the next cell on the shortest route to the exit, creating the flow field the first time it is needed"""
+        if self._flow_field is None:
+            self._flow_field = FlowField(self._walls, [self._exit_pos])
+        return self._flow_field.get_next_hop(pos)
+
     def _update_agent_strategies(self):
         """Updates all agent's strategies"""
-        for agent in self._agents:
-            agent.update_distance_to_exit(self._exit_pos)
-        for agent in self._agents:
-            agent.update_t_i(self._agents, self._exit_capacity)
-        for agent in self._agents:
-            agent.update_strategy(self._c, self._agents)
+        if self._incremental_strategies:
+            self._update_indexed_agent_strategies()
+        else:
+            for agent in self._agents:
+                agent.update_distance_to_exit(self._exit_pos)
+            for agent in self._agents:
+                agent.update_t_i(self._agents, self._exit_capacity)
+            for agent in self._agents:
+                agent.update_strategy(self._c, self._agents)
         patient_agents = 0
         impatient_agents = 0
         neutral_agents = 0
@@ -107,18 +215,42 @@ class SpatialDynamics:
         self._impatient_distribution.append(impatient_agents / (patient_agents + impatient_agents + neutral_agents))
         self._neutral_distribution.append(neutral_agents / (patient_agents + impatient_agents + neutral_agents))
 
+    def _update_indexed_agent_strategies(self):
+        """Recalculates every agent's strategy, finding t_i and Moore neighbours without comparing every pair of agents
+        Agents are not skipped when their inputs are unchanged, as t_i is a rank among all agents so every exit changes it for everyone behind"""
+        for agent in self._agents:
+            agent.update_distance_to_exit(self._exit_pos)
+        # t_i is the number of agents closer to the exit, found by a binary search rather than comparing every pair
+        sorted_distances = sorted(agent.get_distance_to_exit() for agent in self._agents)
+        for agent in self._agents:
+            agent.update_t_i_from_sorted(sorted_distances, self._exit_capacity)
+        # Look up agents by position so neighbours are found without looping through every agent
+        agents_at = {agent.get_pos(): agent for agent in self._agents}
+        agent_order = {agent: i for i, agent in enumerate(self._agents)}
+        for agent in self._agents:
+            x, y = agent.get_pos()
+            neighbours = [agents_at[(x + x2, y + y2)] for y2 in range(-1, 2) for x2 in range(-1, 2) if (x2, y2) != (0, 0) and (x + x2, y + y2) in agents_at]
+            # Keep the same order as the agent list so costs are summed exactly as a full recalculation would
+            neighbours.sort(key=agent_order.get)
+            agent.update_strategy(self._c, neighbours)
+
     def _move_agents(self):
         """Moves agents using the probability based model"""
         moves = []
+        # Agents in the Moore neighbourhood of the exit are queueing for it
+        exit_x, exit_y = self._exit_pos
+        neighbourhood = (slice(exit_y - 1, exit_y + 2), slice(exit_x - 1, exit_x + 2))
+        queue_length = int(np.count_nonzero(self._occupied[neighbourhood] & ~self._walls[neighbourhood]))
+        self._analytics.start_move_step(self._time, queue_length)
         # Calculate probability to move to each neighbouring cell
         for agent in self._agents:
             agent_moves, agent_probabilities = [], []
             print(f'\nMove probabilities for agent at {agent.get_pos()}:')
+            next_hop = self._get_next_hop(agent.get_pos()) if self._route_bias else None
             # Loop through cells in Moore neighbourhood
             for y in range(-1, 2):
                 for x in range(-1, 2):
                     move = (agent.get_pos()[0] + x, agent.get_pos()[1] + y)
-                    cell = self._grid[move[1]][move[0]]
                     sf_multiplier, df_multiplier = 1, 1
                     # If agent is impatient, they are more inclined to rush to the exit, this is reflected by increasing sf
                     if agent.get_strategy() == 'i':
@@ -127,10 +259,13 @@ class SpatialDynamics:
                     elif agent.get_strategy() == 'n':
                         df_multiplier = 10
                     # Calculate probability (not normalised yet)
-                    probability = math.pow(math.e, cell.get_df() * self._df_strength * df_multiplier) * math.pow(math.e, (cell.get_sf() * self._sf_strength * sf_multiplier)) * (1 - cell.get_occupied_multiplier())
+                    probability = math.pow(math.e, self._df[move[1], move[0]] * self._df_strength * df_multiplier) * math.pow(math.e, (self._sf[move[1], move[0]] * self._sf_strength * sf_multiplier)) * (1 - self._occupied[move[1], move[0]])
                     # Apply deterrent to move if agent has been here already
                     if move in agent.get_route_taken():
                         probability *= agent.get_deterrent(move)
+                    # If route bias is on, agents are more inclined to follow the shortest route to the exit
+                    if move == next_hop:
+                        probability *= math.exp(self._route_bias)
                     # Save move and probability
                     print(pad('%.3f' % probability, 8), end=' | ')
                     agent_moves.append(move)
@@ -208,80 +343,89 @@ class SpatialDynamics:
                     neutral_agents.remove(chosen_agent)
                     space_available -= 1
 
+                # Any agents left over lost the contention and stay where they are
+                for agent in impatient_agents + patient_agents + neutral_agents:
+                    self._analytics.record_contention_loss(agent.get_strategy())
+
+        self._analytics.end_move_step(self._count_open_cells())
+
         print('\nGrid df values:')
-        for row in self._grid:
-            for column in row:
-                if not column.is_border():
-                    print('%.3f' % column.get_df(), end=' | ')
+        for row in self._df[1:-1, 1:-1]:
+            for df in row:
+                print('%.3f' % df, end=' | ')
             print()
 
+    def _count_open_cells(self):
+        """Returns the number of cells that are not walls, only recounted after walls have changed"""
+        if self._open_cells is None:
+            self._open_cells = int(np.count_nonzero(~self._walls))
+        return self._open_cells
+
+    def get_analytics(self):
+        """Accessor method"""
+        return self._analytics
+
+    def has_agents(self):
+        """Returns whether any agents are left on the grid"""
+        return len(self._agents) > 0
+
     def _move_agent(self, agent, pos):
         """Moves an agent to a specified position"""
+        self._analytics.record_move(agent.get_pos(), pos)
         # If move is the exit, remove the agent from the grid and add their df trail
         if pos == self._exit_pos:
-            self._grid[agent.get_pos()[1]][agent.get_pos()[0]].set_occupied(False)
+            self._occupied[agent.get_pos()[1], agent.get_pos()[0]] = False
             agent.move(pos)
             # Multiplier is used to scale df value dependant on how recently the agent was there
             # This encourages agents following the trail to move in the correct direction
             current_multiplier = 1
             length = len(agent.get_route_taken())
             for grid_pos in agent.get_route_taken():
-                self._grid[grid_pos[1]][grid_pos[0]].change_df(self._df_increase * (current_multiplier / length))
-                self._grid[grid_pos[1]][grid_pos[0]].update_to_new_df()
+                self._df[grid_pos[1], grid_pos[0]] = clamp(self._df[grid_pos[1], grid_pos[0]] + self._df_increase * (current_multiplier / length), 0, 1)
                 current_multiplier += 1
             self._agents.remove(agent)
+            self._analytics.record_exit(agent.get_strategy(), self._time - agent.get_start_time())
             print(f'Agent at: {agent.get_pos()} has left through the exit.')
         # Otherwise move agent as normal
         else:
             old_pos = agent.get_pos()
             agent.move(pos)
             print(f'Agent at: {old_pos} has moved to {agent.get_pos()}.')
-            self._grid[old_pos[1]][old_pos[0]].set_occupied(False)
+            self._occupied[old_pos[1], old_pos[0]] = False
             # Deprecated method of increasing df on every move
             # New method of adding df when agent reaches exit encourages agents to only follow agents that were successful in their escape
-            # self._grid[old_pos[1]][old_pos[0]].change_df(self._df_increase)
-            # self._grid[old_pos[1]][old_pos[0]].update_to_new_df()
-            self._grid[agent.get_pos()[1]][agent.get_pos()[0]].set_occupied(True)
+            # self._df[old_pos[1], old_pos[0]] = clamp(self._df[old_pos[1], old_pos[0]] + self._df_increase, 0, 1)
+            self._occupied[agent.get_pos()[1], agent.get_pos()[0]] = True
 
     def _diffuse_df(self):
         """Diffuses df values for each cell to neighbouring cells"""
-        for x in range(self._grid_size[0]):
-            for y in range(self._grid_size[1]):
-                if not self._grid[y][x].is_wall():
-                    neighbours = []
-                    for x2 in range(-1, 2):
-                        for y2 in range(-1, 2):
-                            if not (x2 == 0 and y2 == 0):
-                                neighbours.append((x + x2, y + y2))
-                    diffuse_rate = self._df_diffuse_rate
-                    if self._grid[y][x].get_df() <= self._df_diffuse_rate:
-                        diffuse_rate = self._grid[y][x].get_df()
-                    self._grid[y][x].change_df(-diffuse_rate)
-                    diffuse_spread = diffuse_rate / len(neighbours)
-                    for neighbour in neighbours:
-                        self._grid[neighbour[1]][neighbour[0]].change_df(diffuse_spread)
-
-        for x in range(self._grid_size[0]):
-            for y in range(self._grid_size[1]):
-                self._grid[y][x].update_to_new_df()
+        # Each cell that is not a wall gives away up to the diffuse rate, split evenly between its 8 neighbours
+        diffuse_rate = np.where(self._walls, 0, np.minimum(self._df, self._df_diffuse_rate))
+        diffuse_spread = np.pad(diffuse_rate / 8, 1)
+        df_change = -diffuse_rate
+        for x2 in range(-1, 2):
+            for y2 in range(-1, 2):
+                if not (x2 == 0 and y2 == 0):
+                    df_change += diffuse_spread[1 + y2:1 + y2 + self._grid_size[1], 1 + x2:1 + x2 + self._grid_size[0]]
+        self._df = np.clip(self._df + df_change, 0, 1)
 
     def _draw_grid(self):
         """Draws everything to the window using pygame, to be called every frame"""
+        import pygame as pg
         # Background fill
         self._window.fill((255, 255, 255))
         # Draw cells
         for x in range(0, self._grid_size[0]):
             for y in range(0, self._grid_size[1]):
-                cell = self._grid[y][x]
                 # If show probabilities is on, df values affect the brightness of the cell, otherwise it is one colour
                 if self._show_probs:
-                    if cell.is_wall():
+                    if self._walls[y, x]:
                         colour = (255, 255, 255)
                     else:
-                        multiplier = clamp(cell.get_df() + cell.get_sf(), 0, 1)
+                        multiplier = clamp(self._df[y, x] + self._sf[y, x], 0, 1)
                         colour = (255 * multiplier, 0, 255 * multiplier)
                 else:
-                    if cell.is_wall():
+                    if self._walls[y, x]:
                         colour = (0, 0, 0)
                     else:
                         colour = (255, 255, 255)
@@ -325,22 +469,54 @@ class SpatialDynamics:
         # Update the display to add the new things we drew
         pg.display.update()
 
+    def render_frame(self, highlight=None):
+        """Draws the grid into an array of pixels without opening a window
+        highlight is a list of positions whose agents have their route drawn, like hovering over them, or 'all' for every agent"""
+        if self._renderer is None:
+            self._renderer = FrameRenderer(self._grid_size, self._cell_size, self._exit_pos, self._show_probs)
+        routes = [(agent.get_route_taken(), agent.get_strategy()) for agent in self._agents if highlight == 'all' or (highlight is not None and agent.get_pos() in highlight)]
+        return self._renderer.render(self._walls, self._sf, self._df, [(agent.get_pos(), agent.get_strategy()) for agent in self._agents], routes)
+
+    def record(self, path, steps, every=1, fps=10, highlight=None):
+        """Runs the simulation without a window for a number of steps, saving a frame every few steps
+        Paths ending in .gif are saved as animated GIFs, anything else as video, strategy plots are not saved while recording"""
+        frame = self.render_frame(highlight)
+        if path.endswith('.gif'):
+            writer = GifWriter(path, fps)
+        else:
+            writer = VideoWriter(path, frame.shape[1], frame.shape[0], fps)
+        save_plots, self._save_plots = self._save_plots, False
+        try:
+            writer.write(frame)
+            for step in range(1, steps + 1):
+                if len(self._agents) == 0:
+                    break
+                self._run_one_step()
+                if step % every == 0:
+                    writer.write(self.render_frame(highlight))
+        finally:
+            self._save_plots = save_plots
+            writer.close()
+
     def _clear_cell(self, pos):
         """Clears any agent or wall from cell, except for border walls"""
-        if self._grid[pos[1]][pos[0]].is_wall():
-            if not self._grid[pos[1]][pos[0]].is_border():
-                self._grid[pos[1]][pos[0]].clear_wall()
+        if self._walls[pos[1], pos[0]]:
+            if not self._borders[pos[1], pos[0]]:
+                self._walls[pos[1], pos[0]], self._occupied[pos[1], pos[0]] = False, False
+                self._walls_changed([pos])
                 return True
         else:
             for agent in self._agents:
                 if agent.get_pos() == pos:
                     self._agents.remove(agent)
-                    self._grid[pos[1]][pos[0]].set_occupied(False)
+                    self._occupied[pos[1], pos[0]] = False
+                    self._analytics.record_agent_removed(pos)
                     return True
         return False
 
     def _on_mouse_down(self):
         """Called when a mouse button is clicked"""
+        import pygame as pg
         pos = pg.mouse.get_pos()
         # If left button, add agent at cursor position
         if self._mouse_button_down == 1:
@@ -348,6 +524,7 @@ class SpatialDynamics:
 
     def _while_mouse_down(self):
         """Called every tick while a mouse button is held down"""
+        import pygame as pg
         pos = pg.mouse.get_pos()
         # If middle button, add wall at cursor position
         if self._mouse_button_down == 2:
@@ -358,6 +535,7 @@ class SpatialDynamics:
 
     def _plot_strategies(self):
         """Plots agent strategy distribution to graph"""
+        import matplotlib.pyplot as plt
         plt.close()
         t = np.arange(0, self._time, 1)
         fig, ax = plt.subplots()
@@ -378,24 +556,82 @@ class SpatialDynamics:
         if len(self._agents) > 0:
             if not self._move:
                 self._update_agent_strategies()
-                self._plot_strategies()
+                if self._save_plots:
+                    self._plot_strategies()
             else:
                 self._move_agents()
                 self._diffuse_df()
             self._move = not self._move
             print(f'Time step: {self._time}')
 
+    def step(self):
+        """Runs one step and returns what changed, so remote viewers can be sent deltas instead of the whole grid
+        Strategy plots are never saved here, as this runs without a window and often without an img folder"""
+        before = {agent: (agent.get_pos(), agent.get_strategy()) for agent in self._agents}
+        df_before = self._df.copy()
+        save_plots, self._save_plots = self._save_plots, False
+        try:
+            self._run_one_step()
+        finally:
+            self._save_plots = save_plots
+        moves, strategies = [], []
+        for agent in self._agents:
+            old_pos, old_strategy = before.pop(agent)
+            if agent.get_pos() != old_pos:
+                moves.append([old_pos[0], old_pos[1], agent.get_pos()[0], agent.get_pos()[1]])
+            if agent.get_strategy() != old_strategy:
+                strategies.append([agent.get_pos()[0], agent.get_pos()[1], agent.get_strategy()])
+        # Any agents left over have gone through the exit
+        exits = [[old_pos[0], old_pos[1]] for old_pos, _ in before.values()]
+        df_y, df_x = np.nonzero(self._df != df_before)
+        df = [[int(x), int(y), float(self._df[y, x])] for x, y in zip(df_x, df_y)]
+        return {'time': self._time, 'move': self._move, 'moves': moves, 'exits': exits, 'strategies': strategies, 'df': df}
+
+    def get_state(self):
+        """Returns the whole layout, sent to remote viewers when they first connect"""
+        walls_y, walls_x = np.nonzero(self._walls & ~self._borders)
+        df_y, df_x = np.nonzero(self._df)
+        return {
+            'grid_size': list(self._grid_size),
+            'exit': list(self._exit_pos),
+            'time': self._time,
+            'move': self._move,
+            'walls': [[int(x), int(y)] for x, y in zip(walls_x, walls_y)],
+            'agents': [[agent.get_pos()[0], agent.get_pos()[1], agent.get_strategy()] for agent in self._agents],
+            'df': [[int(x), int(y), float(self._df[y, x])] for x, y in zip(df_x, df_y)]
+        }
+
+    def get_cell_state(self, pos):
+        """Returns whether a cell is a wall and the strategy of any agent in it"""
+        strategy = None
+        for agent in self._agents:
+            if agent.get_pos() == pos:
+                strategy = agent.get_strategy()
+        return {'pos': list(pos), 'wall': bool(self._walls[pos[1], pos[0]]), 'agent': strategy}
+
+    def edit_cell(self, action, pos):
+        """Same as the mouse controls, action is 'agent' to add an agent or change its strategy, 'wall' to add a wall or 'clear'"""
+        if not (0 <= pos[0] <= self._grid_size[0] - 1 and 0 <= pos[1] <= self._grid_size[1] - 1):
+            return False
+        if action == 'agent':
+            return self._add_agent(pos, 'p')
+        elif action == 'wall':
+            return self._add_wall(pos)
+        elif action == 'clear':
+            return self._clear_cell(pos)
+        return False
+
     def _save_setup(self):
         """Saves current layout to text file to be loaded later"""
         with open('save.txt', 'w') as file:
             file.write(f'Grid size:{self._grid_size[0]},{self._grid_size[1]}\n')
-            for row in self._grid:
-                for column in row:
-                    if column.is_border():
+            for y in range(self._grid_size[1]):
+                for x in range(self._grid_size[0]):
+                    if self._borders[y, x]:
                         file.write('b')
-                    elif column.is_wall():
+                    elif self._walls[y, x]:
                         file.write('w')
-                    elif column.get_occupied_multiplier() == 1:
+                    elif self._occupied[y, x]:
                         file.write('a')
                     else:
                         file.write('e')
@@ -409,11 +645,10 @@ class SpatialDynamics:
             with open('save.txt', 'r') as file:
                 size = file.readline().split(':')[1].split('\n')[0].split(',')
                 if int(size[0]) == self._grid_size[0] and int(size[1]) == self._grid_size[1]:
-                    self._agents = []
-                    for row in self._grid:
-                        for column in row:
-                            if not column.is_border():
-                                column.clear_wall()
+                    for agent in self._agents:
+                        self._analytics.record_agent_removed(agent.get_pos())
+                    self._agents, self._open_cells, self._flow_field = [], None, None
+                    self._walls, self._occupied = self._borders.copy(), self._borders.copy()
                     row = 0
                     for line in file.readlines():
                         column = 0
@@ -421,7 +656,7 @@ class SpatialDynamics:
                         cells.remove('\n')
                         for cell in cells:
                             if cell == 'w':
-                                self._grid[row][column].add_wall()
+                                self._walls[row, column], self._occupied[row, column] = True, True
                             elif cell == 'a':
                                 self._add_agent((column, row), 'p')
                             column += 1
@@ -433,6 +668,8 @@ class SpatialDynamics:
 
     def start(self):
         """Main loop for the simulation"""
+        import pygame as pg
+        import matplotlib.pyplot as plt
         # Start pygame and create a window
         pg.init()
         self._window = pg.display.set_mode(((self._grid_size[0]) * self._cell_size, (self._grid_size[1]) * self._cell_size))
@@ -511,5 +748,8 @@ if __name__ == '__main__':
     )
     # Uncomment line below to pre fill grid with agents
     # sim.fill_grid_random(0.05, 0.05, 0.05)
+    # Uncomment lines below (and remove sim.start()) to stream the simulation to remote viewers instead of opening a window
+    # from server import SimulationServer
+    # SimulationServer(sim).start()
     # Run the simulation
     sim.start()
@@ -1,89 +1,260 @@
-"""This file is deprecated, was used while testing options for pathfinding but eventually discarded"""
+import heapq
+import math
+import numpy as np
 
+# Moore neighbourhood offsets (x, y) and the cost of moving along them
+NEIGHBOURS = [(x, y, math.sqrt(x * x + y * y)) for y in range(-1, 2) for x in range(-1, 2) if (x, y) != (0, 0)]
 
-class Node:
-    def __init__(self, parent=None, position=None):
-        self.parent = parent
-        self.position = position
 
-        self.g = 0
-        self.h = 0
-        self.f = 0
+def local_distances(passable, sources):
+    """Distance from each source to every cell, only moving through passable cells of the same area
+    passable is an areas x height x width boolean array and sources is a list of (x, y) positions for each area
+    Returns a list with a sources x height x width array for each area"""
+    areas, height, width = passable.shape
+    most_sources = max([len(area_sources) for area_sources in sources] + [1])
+    distance = np.full((areas, most_sources, height, width), np.inf)
+    for area, area_sources in enumerate(sources):
+        for i, (x, y) in enumerate(area_sources):
+            distance[area, i, y, x] = 0
+    blocked = ~passable[:, np.newaxis]
+    # Relax every cell from its neighbours until nothing changes, for all areas and sources at once
+    while True:
+        new_distance = distance.copy()
+        for x, y, cost in NEIGHBOURS:
+            target = new_distance[..., max(y, 0):height + min(y, 0), max(x, 0):width + min(x, 0)]
+            source = distance[..., max(-y, 0):height + min(-y, 0), max(-x, 0):width + min(-x, 0)]
+            np.minimum(target, source + cost, out=target)
+        np.putmask(new_distance, np.broadcast_to(blocked, new_distance.shape), np.inf)
+        if np.array_equal(new_distance, distance):
+            return [distance[area, :len(area_sources)] for area, area_sources in enumerate(sources)]
+        distance = new_distance
 
-    def __eq__(self, other):
-        return self.position == other.position
 
+class FlowField:
+    def __init__(self, walls, exits, cluster_size=16):
+        """Creates a next hop for every cell towards the nearest exit, walls is a boolean array indexed [y][x]
+        The grid is split into clusters, linked by entrances where their borders can be crossed
+        Distances inside each cluster are cached, so changing walls only recalculates the clusters they are in"""
+        self._walls = np.array(walls, dtype=bool)
+        self._exits = [tuple(exit_pos) for exit_pos in exits]
+        self._height, self._width = self._walls.shape
+        self._cluster_size = cluster_size
+        self._clusters_x = math.ceil(self._width / cluster_size)
+        self._clusters_y = math.ceil(self._height / cluster_size)
+        # Entrances for each border between clusters, as (cell, cell, cost) links
+        self._entrances = {}
+        # Nodes (entrance cells and exits) of each cluster, their distances to every cell in that cluster and to each other
+        self._nodes, self._local, self._links = {}, {}, {}
+        # Distance from each node to the nearest exit, through the cluster graph
+        self._node_distance = {}
+        # Distance to the nearest exit for every cell and the next cell to move to, -1 if there is no route
+        self._distance = np.full((self._height, self._width), np.inf)
+        self._next_x = np.full((self._height, self._width), -1)
+        self._next_y = np.full((self._height, self._width), -1)
+        for border in self._all_borders():
+            self._find_entrances(border)
+        clusters = [(cx, cy) for cy in range(self._clusters_y) for cx in range(self._clusters_x)]
+        self._build_clusters(clusters)
+        self._search_cluster_graph()
+        for cluster in clusters:
+            self._fill_cluster(cluster)
+        self._update_next_hops(0, 0, self._width, self._height)
 
-class AStar:
-    def __init__(self, grid_size, exit_pos):
-        self._grid_size = grid_size
-        self._exit_pos = exit_pos
-        self._closed_list = []
+    def get_next_hop(self, pos):
+        """Returns the next cell on the route to the exit, None if there is no route or pos is an exit"""
+        if self._next_x[pos[1], pos[0]] == -1:
+            return None
+        return int(self._next_x[pos[1], pos[0]]), int(self._next_y[pos[1], pos[0]])
 
-    def _is_valid(self, pos):
-        return (pos[0] >= 0) and (pos[0] < self._grid_size[0]) and (pos[1] >= 0) and (pos[1] < self._grid_size[1])
+    def get_distance(self, pos):
+        """Returns the route length from pos to the nearest exit, inf if there is no route"""
+        return float(self._distance[pos[1], pos[0]])
 
-    def _calculate_h_value(self, pos):
-        return ((pos[0] - self._exit_pos[0]) ** 2) + ((pos[1] - self._exit_pos[1]) ** 2)
+    def update_cells(self, walls, positions):
+        """Updates the flow field after walls changed at the given positions, only recalculating the clusters affected"""
+        self._walls = np.array(walls, dtype=bool)
+        changed_clusters = {self._cluster_of(pos) for pos in positions}
+        # Entrances on any border of a changed cluster may have moved, so may the nodes of the cluster on the other side
+        rebuild = set(changed_clusters)
+        for border in {border for cluster in changed_clusters for border in self._borders_of(cluster)}:
+            old_entrances = self._entrances.get(border)
+            self._find_entrances(border)
+            if self._entrances[border] != old_entrances:
+                rebuild.update(self._clusters_of_border(border))
+        self._build_clusters(rebuild)
+        # Node distances can change anywhere, clusters are refilled if their cached distances or node distances changed
+        old_node_distance = self._node_distance
+        self._search_cluster_graph()
+        refill = set(rebuild)
+        for cluster, nodes in self._nodes.items():
+            if any(old_node_distance.get(node) != self._node_distance.get(node) for node in nodes):
+                refill.add(cluster)
+        for cluster in refill:
+            self._fill_cluster(cluster)
+            # Next hops depend on neighbouring cells, so include a one cell margin around the cluster
+            x0, y0, x1, y1 = self._cluster_bounds(cluster)
+            self._update_next_hops(max(x0 - 1, 0), max(y0 - 1, 0), min(x1 + 1, self._width), min(y1 + 1, self._height))
 
-    @staticmethod
-    def _sort_list(lst):
-        lst.sort(key=lambda x: x.f)
+    def _cluster_of(self, pos):
+        """Returns the cluster a cell is in"""
+        return pos[0] // self._cluster_size, pos[1] // self._cluster_size
 
-    @staticmethod
-    def _get_path(current_node):
-        path = []
-        current = current_node
-        while current is not None:
-            path.append(current.position)
-            current = current.parent
-        return path[::-1][1::]
+    def _cluster_bounds(self, cluster):
+        """Returns the cells a cluster covers as (x0, y0, x1, y1), end exclusive"""
+        x0, y0 = cluster[0] * self._cluster_size, cluster[1] * self._cluster_size
+        return x0, y0, min(x0 + self._cluster_size, self._width), min(y0 + self._cluster_size, self._height)
 
-    def search(self, grid, src):
-        if not (self._is_valid(src) and self._is_valid(self._exit_pos)):
-            print("Source or destination is invalid")
-            return False
+    def _all_borders(self):
+        """Every border between neighbouring clusters, as (kind, cx, cy)
+        'v' is between (cx, cy) and (cx + 1, cy), 'h' is between (cx, cy) and (cx, cy + 1),
+        'd' is the corner between (cx, cy) and (cx + 1, cy + 1), 'a' is the corner between (cx + 1, cy) and (cx, cy + 1)"""
+        borders = []
+        for cy in range(self._clusters_y):
+            for cx in range(self._clusters_x):
+                if cx + 1 < self._clusters_x:
+                    borders.append(('v', cx, cy))
+                if cy + 1 < self._clusters_y:
+                    borders.append(('h', cx, cy))
+                if cx + 1 < self._clusters_x and cy + 1 < self._clusters_y:
+                    borders.append(('d', cx, cy))
+                    borders.append(('a', cx, cy))
+        return borders
 
-        start_node = Node(None, src)
-        end_node = Node(None, self._exit_pos)
+    def _clusters_of_border(self, border):
+        """Returns the two clusters either side of a border"""
+        kind, cx, cy = border
+        if kind == 'v':
+            return (cx, cy), (cx + 1, cy)
+        elif kind == 'h':
+            return (cx, cy), (cx, cy + 1)
+        elif kind == 'd':
+            return (cx, cy), (cx + 1, cy + 1)
+        return (cx + 1, cy), (cx, cy + 1)
 
-        open_list = [start_node]
-        closed_list = []
+    def _borders_of(self, cluster):
+        """Returns every border a cluster is on"""
+        cx, cy = cluster
+        borders = [('v', cx, cy), ('v', cx - 1, cy), ('h', cx, cy), ('h', cx, cy - 1),
+                   ('d', cx, cy), ('d', cx - 1, cy - 1), ('a', cx, cy - 1), ('a', cx - 1, cy)]
+        return [border for border in borders if 0 <= border[1] < self._clusters_x and 0 <= border[2] < self._clusters_y and border in self._entrances]
 
-        while len(open_list) != 0:
-            self._sort_list(open_list)
-            current = open_list[0]
-            open_list.remove(current)
-            closed_list.append(current)
+    def _passable(self, x, y):
+        """Returns True if the cell is inside the grid and not a wall"""
+        return 0 <= x < self._width and 0 <= y < self._height and not self._walls[y, x]
 
-            i, j = current.position
-            neighbours = [(i, j-1), (i, j+1), (i+1, j), (i-1, j), (i+1, j-1), (i-1, j-1), (i+1, j+1), (i-1, j+1)]
-            children = []
-            for next_i, next_j in neighbours:
-                if not self._is_valid((next_i, next_j)):
-                    continue
+    def _find_entrances(self, border):
+        """Finds where a border can be crossed, one entrance in the middle of each open stretch of the border"""
+        kind, cx, cy = border
+        entrances = []
+        if kind in ('d', 'a'):
+            # Corners can only be crossed diagonally, between the two corner cells
+            x = (cx + 1) * self._cluster_size - 1
+            y = (cy + 1) * self._cluster_size - 1
+            a, b = ((x, y), (x + 1, y + 1)) if kind == 'd' else ((x + 1, y), (x, y + 1))
+            if self._passable(*a) and self._passable(*b):
+                entrances.append((a, b, math.sqrt(2)))
+        else:
+            # Cells along the border on this side (a) and the other side (b)
+            if kind == 'v':
+                x = (cx + 1) * self._cluster_size - 1
+                y0, y1 = self._cluster_bounds((cx, cy))[1::2]
+                pairs = [((x, y), (x + 1, y)) for y in range(y0, y1)]
+            else:
+                y = (cy + 1) * self._cluster_size - 1
+                x0, x1 = self._cluster_bounds((cx, cy))[0::2]
+                pairs = [((x, y), (x, y + 1)) for x in range(x0, x1)]
+            straight = [self._passable(*a) and self._passable(*b) for a, b in pairs]
+            # One entrance in the middle of each stretch where the border can be crossed straight over
+            start = None
+            for i in range(len(pairs) + 1):
+                if i < len(pairs) and straight[i]:
+                    if start is None:
+                        start = i
+                elif start is not None:
+                    entrances.append(pairs[(start + i - 1) // 2] + (1,))
+                    start = None
+            # Diagonal crossings are only needed where there is no straight crossing next to them
+            for i in range(len(pairs) - 1):
+                if not (straight[i] or straight[i + 1]):
+                    (a0, b0), (a1, b1) = pairs[i], pairs[i + 1]
+                    if self._passable(*a0) and self._passable(*b1):
+                        entrances.append((a0, b1, math.sqrt(2)))
+                    if self._passable(*a1) and self._passable(*b0):
+                        entrances.append((a1, b0, math.sqrt(2)))
+        self._entrances[border] = entrances
 
-                if (next_i, next_j) == self._exit_pos:
-                    end_node.parent = current
-                    return self._get_path(end_node)
+    def _build_clusters(self, clusters, batch_size=256):
+        """Finds the nodes of each cluster and caches their distances to every cell in it"""
+        # Clusters the same shape have their distances found together, in batches to limit memory
+        by_shape = {}
+        for cluster in clusters:
+            nodes = set()
+            for border in self._borders_of(cluster):
+                for a, b, _ in self._entrances[border]:
+                    nodes.update(cell for cell in (a, b) if self._cluster_of(cell) == cluster)
+            nodes.update(exit_pos for exit_pos in self._exits if self._cluster_of(exit_pos) == cluster)
+            self._nodes[cluster] = sorted(nodes)
+            x0, y0, x1, y1 = self._cluster_bounds(cluster)
+            by_shape.setdefault((y1 - y0, x1 - x0), []).append(cluster)
+        for same_shape in by_shape.values():
+            for start in range(0, len(same_shape), batch_size):
+                batch = same_shape[start:start + batch_size]
+                passable, sources = [], []
+                for cluster in batch:
+                    x0, y0, x1, y1 = self._cluster_bounds(cluster)
+                    passable.append(~self._walls[y0:y1, x0:x1])
+                    sources.append([(x - x0, y - y0) for x, y in self._nodes[cluster]])
+                for cluster, distance, cluster_sources in zip(batch, local_distances(np.array(passable), sources), sources):
+                    self._local[cluster] = distance
+                    # Distances between every pair of nodes in the cluster, linking them in the cluster graph
+                    xs, ys = [x for x, _ in cluster_sources], [y for _, y in cluster_sources]
+                    node_distance = distance[:, ys, xs]
+                    nodes = self._nodes[cluster]
+                    self._links[cluster] = [(nodes[i], nodes[j], node_distance[i, j]) for i, j in zip(*np.nonzero(np.isfinite(node_distance))) if i != j]
 
-                elif grid[next_j][next_i].is_wall():
-                    continue
+    def _search_cluster_graph(self):
+        """Finds the distance from every node to the nearest exit, using cached distances within clusters and entrances between them"""
+        links = {}
+        for cluster_links in self._links.values():
+            for node, other, distance in cluster_links:
+                links.setdefault(node, []).append((other, distance))
+        for entrances in self._entrances.values():
+            for a, b, cost in entrances:
+                links.setdefault(a, []).append((b, cost))
+                links.setdefault(b, []).append((a, cost))
+        # Dijkstra's algorithm from every exit at once
+        node_distance = {}
+        queue = [(0, exit_pos) for exit_pos in self._exits if self._passable(*exit_pos)]
+        heapq.heapify(queue)
+        while queue:
+            distance, node = heapq.heappop(queue)
+            if node in node_distance:
+                continue
+            node_distance[node] = distance
+            for other, cost in links.get(node, []):
+                if other not in node_distance:
+                    heapq.heappush(queue, (distance + cost, other))
+        self._node_distance = node_distance
 
-                children.append(Node(current, (next_i, next_j)))
+    def _fill_cluster(self, cluster):
+        """Sets the distance to the exit of every cell in a cluster, through whichever of its nodes is best"""
+        x0, y0, x1, y1 = self._cluster_bounds(cluster)
+        node_distance = np.array([self._node_distance.get(node, np.inf) for node in self._nodes[cluster]])
+        if len(node_distance) == 0:
+            self._distance[y0:y1, x0:x1] = np.inf
+        else:
+            self._distance[y0:y1, x0:x1] = (self._local[cluster] + node_distance[:, np.newaxis, np.newaxis]).min(axis=0)
 
-            for child in children:
-                if len([closed_child for closed_child in closed_list if closed_child == child]) > 0:
-                    continue
-
-                child.g = current.g + 1
-                child.h = self._calculate_h_value(child.position)
-                child.f = child.g + child.h
-
-                if len([open_node for open_node in open_list if child.position == open_node.position and child.g > open_node.g]) > 0:
-                    continue
-
-                open_list.append(child)
-
-        print("No path found")
-        return False
+    def _update_next_hops(self, x0, y0, x1, y1):
+        """Points every cell in the area at the neighbour that is furthest along the route, only ever moving closer to the exit"""
+        padded = np.pad(self._distance, 1, constant_values=np.inf)
+        distance = self._distance[y0:y1, x0:x1]
+        best = np.full(distance.shape, np.inf)
+        next_x, next_y = np.full(distance.shape, -1), np.full(distance.shape, -1)
+        x, y = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+        for x2, y2, cost in NEIGHBOURS:
+            neighbour = padded[1 + y0 + y2:1 + y1 + y2, 1 + x0 + x2:1 + x1 + x2]
+            better = (neighbour < distance) & (neighbour + cost < best)
+            best = np.where(better, neighbour + cost, best)
+            next_x, next_y = np.where(better, x + x2, next_x), np.where(better, y + y2, next_y)
+        self._next_x[y0:y1, x0:x1], self._next_y[y0:y1, x0:x1] = next_x, next_y
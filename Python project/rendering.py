@@ -0,0 +1,116 @@
+import shutil
+import subprocess
+import numpy as np
+
+# Agent colours, same as the pygame window: blue for patient, red for impatient, green for neutral
+AGENT_COLOURS = {'p': (0, 0, 255), 'i': (255, 0, 0), 'n': (0, 200, 0)}
+
+
+class FrameRenderer:
+    def __init__(self, grid_size, cell_size, exit_pos, show_probs=True):
+        """Draws the simulation into arrays of pixels (height x width x 3), without needing a window"""
+        self._grid_size, self._cell_size, self._exit_pos, self._show_probs = grid_size, cell_size, exit_pos, show_probs
+        self._height, self._width = grid_size[1] * cell_size, grid_size[0] * cell_size
+        # Pixels covered by grid lines and by an agent's circle are worked out once and reused for every frame
+        self._lines = np.zeros((self._height, self._width), dtype=bool)
+        self._lines[cell_size::cell_size, :] = True
+        self._lines[:, cell_size::cell_size] = True
+        centre = (np.arange(cell_size) + 0.5) - cell_size / 2
+        self._circle_y, self._circle_x = np.nonzero((centre[np.newaxis, :] ** 2 + centre[:, np.newaxis] ** 2) <= (cell_size / 3) ** 2)
+
+    def render(self, walls, sf, df, agents, routes=None):
+        """Returns a frame of the grid, agents is a list of (pos, strategy) and routes a list of (route, strategy) to draw over it"""
+        # Cell colours, if show probabilities is on df and sf values affect the brightness of the cell
+        if self._show_probs:
+            multiplier = np.clip(df + sf, 0, 1) * 255
+            cells = np.stack((multiplier, np.zeros_like(multiplier), multiplier), axis=2)
+            cells[walls] = 255
+        else:
+            cells = np.full(walls.shape + (3,), 255.0)
+            cells[walls] = 0
+        cells[self._exit_pos[1], self._exit_pos[0]] = (0, 255, 0)
+        # Scale cells up to pixels
+        frame = np.repeat(np.repeat(cells.astype(np.uint8), self._cell_size, axis=0), self._cell_size, axis=1)
+        frame[self._lines] = 0
+        # Stamp the cached circle in the middle of every agent's cell, one colour at a time
+        for strategy, colour in AGENT_COLOURS.items():
+            positions = np.array([pos for pos, agent_strategy in agents if agent_strategy == strategy], dtype=np.int64).reshape(-1, 2)
+            if len(positions):
+                y = (positions[:, 1, np.newaxis] * self._cell_size + self._circle_y).ravel()
+                x = (positions[:, 0, np.newaxis] * self._cell_size + self._circle_x).ravel()
+                frame[y, x] = colour
+        for route, strategy in routes or []:
+            self._draw_route(frame, route, AGENT_COLOURS[strategy])
+        return frame
+
+    def _draw_route(self, frame, route, colour, width=5):
+        """Draws lines between the centres of each cell on a route"""
+        if len(route) < 2:
+            return
+        centres = np.array(route, dtype=float) * self._cell_size + self._cell_size * 0.5
+        x, y = [], []
+        for (x0, y0), (x1, y1) in zip(centres[:-1], centres[1:]):
+            points = int(max(abs(x1 - x0), abs(y1 - y0))) + 1
+            x.append(np.linspace(x0, x1, points))
+            y.append(np.linspace(y0, y1, points))
+        x, y = np.concatenate(x).astype(np.int64), np.concatenate(y).astype(np.int64)
+        # Thicken the line by drawing it again at every offset within its width
+        offsets = np.arange(width) - width // 2
+        x, y = np.broadcast_arrays(x[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis], y[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :])
+        x, y = x.ravel(), y.ravel()
+        inside = (0 <= x) & (x < self._width) & (0 <= y) & (y < self._height)
+        frame[y[inside], x[inside]] = colour
+
+
+class GifWriter:
+    def __init__(self, path, fps=10):
+        """Streams frames to an animated GIF, each frame is reduced to its own palette and written as soon as it is added"""
+        self._path, self._duration = path, round(1000 / fps)
+        self._file = None
+
+    def write(self, frame):
+        """Adds a frame to the GIF, the file is started with the first frame"""
+        from PIL import Image, GifImagePlugin
+        image = Image.fromarray(frame).convert('P', palette=Image.ADAPTIVE)
+        if self._file is None:
+            self._file = open(self._path, 'wb')
+            header, _ = GifImagePlugin.getheader(image, info={'loop': 0, 'duration': self._duration})
+            self._file.writelines(header)
+        # Frames carry their own colour table as every frame has a different adaptive palette
+        self._file.writelines(GifImagePlugin.getdata(image, duration=self._duration, include_color_table=True))
+
+    def close(self):
+        """Finishes the GIF file"""
+        if self._file is not None:
+            self._file.write(b';')
+            self._file.close()
+
+
+class VideoWriter:
+    def __init__(self, path, width, height, fps=10):
+        """Streams frames to a video file, using ffmpeg to encode them if it is installed
+        Paths ending in .rgb, or any path when ffmpeg is not found, are written as raw video, which can be converted later with:
+            ffmpeg -f rawvideo -pix_fmt rgb24 -s WIDTHxHEIGHT -r FPS -i video.rgb video.mp4"""
+        self._process, self._file = None, None
+        ffmpeg = shutil.which('ffmpeg')
+        if not path.endswith('.rgb') and ffmpeg is None:
+            path += '.rgb'
+            print(f'ffmpeg not found, writing raw video to {path} instead.')
+        if path.endswith('.rgb'):
+            self._file = open(path, 'wb')
+        else:
+            self._process = subprocess.Popen(
+                [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', path],
+                stdin=subprocess.PIPE
+            )
+            self._file = self._process.stdin
+
+    def write(self, frame):
+        """Adds a frame to the video"""
+        self._file.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+
+    def close(self):
+        """Finishes the video file"""
+        self._file.close()
+        if self._process is not None:
+            self._process.wait()
@@ -0,0 +1,172 @@
+import asyncio
+import json
+from utilities import *
+
+
+class SimulationServer:
+    def __init__(self, sim, host='127.0.0.1', port=8765):
+        """Streams a headless simulation to any number of viewers over TCP, one JSON message per line
+        Viewers are sent the whole layout when they connect ({"type": "state"}) and then only what changes each step ({"type": "delta"})
+        Viewers that stop reading are disconnected once they fall too far behind, so they never slow the simulation or other viewers
+        Viewers can send control messages, equivalent to the keyboard and mouse controls:
+            {"action": "step"}                        runs one step
+            {"action": "run"} / {"action": "pause"}   starts or stops auto run, which stops by itself once every agent has left
+            {"action": "speed", "delay": 0.5}         sets the delay between auto run steps, between 0.1 and 2 seconds
+            {"action": "add_agent", "pos": [x, y]}    adds a patient agent, or changes the strategy of the agent already there
+            {"action": "add_wall", "pos": [x, y]}     adds a wall
+            {"action": "clear", "pos": [x, y]}        removes an agent or wall
+            {"action": "state"}                       resends the whole layout"""
+        self._sim, self._host, self._port = sim, host, port
+        # Every viewer has its own bounded queue of lines, emptied by its own writer task, so a slow viewer never holds up the others
+        self._clients = {}
+        self._queue_size = 256
+        self._running, self._auto_run_delay = False, 0.5
+        # Set whenever auto run is started, so the run loop sleeps instead of polling while paused
+        self._run_event = None
+        # Held while the simulation is stepped in a worker thread, so edits and layouts never see a half finished step
+        self._sim_lock = None
+
+    def start(self):
+        """Runs the server until interrupted"""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print('Server stopped.')
+
+    async def serve(self):
+        """Starts listening for viewers and runs the simulation while auto run is on"""
+        self._run_event, self._sim_lock = asyncio.Event(), asyncio.Lock()
+        server = await asyncio.start_server(self._handle_client, self._host, self._port)
+        print(f'Serving simulation on {self._host}:{self._port}')
+        async with server:
+            await asyncio.gather(server.serve_forever(), self._run_loop())
+
+    async def _run_loop(self):
+        """Runs one step then waits the auto run delay, while auto run is on, pausing once every agent has left or a step fails"""
+        while True:
+            await self._run_event.wait()
+            if not self._sim.has_agents():
+                self._set_running(False)
+                continue
+            if not await self._step():
+                self._set_running(False)
+                continue
+            await asyncio.sleep(self._auto_run_delay)
+
+    def _set_running(self, running):
+        """Starts or stops auto run and tells every viewer"""
+        self._running = running
+        if running:
+            self._run_event.set()
+        else:
+            self._run_event.clear()
+        self._broadcast({'type': 'control', 'running': self._running, 'delay': self._auto_run_delay})
+
+    async def _step(self):
+        """Runs one step in a worker thread, so viewers are still served while it runs, and sends the changes to every viewer
+        Returns False if the step failed, after telling every viewer why"""
+        try:
+            async with self._sim_lock:
+                delta = await asyncio.to_thread(self._sim.step)
+        except Exception as error:
+            self._broadcast({'type': 'error', 'message': f'Step failed: {error!r}'})
+            return False
+        delta['type'] = 'delta'
+        self._broadcast(delta)
+        return True
+
+    def _broadcast(self, message):
+        """Queues a message for every connected viewer"""
+        line = (json.dumps(message) + '\n').encode()
+        for writer in list(self._clients):
+            self._queue(writer, line)
+
+    def _send(self, writer, message):
+        """Queues a message for one viewer"""
+        self._queue(writer, (json.dumps(message) + '\n').encode())
+
+    def _queue(self, writer, line):
+        """Adds a line to a viewer's queue, disconnecting the viewer if it has fallen too far behind to keep up"""
+        queue = self._clients.get(writer)
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self._clients.pop(writer, None)
+            writer.transport.abort()
+
+    async def _write_queue(self, writer, queue):
+        """Writes a viewer's queued lines to it until it disconnects"""
+        try:
+            while True:
+                line = await queue.get()
+                writer.write(line)
+                await writer.drain()
+        except ConnectionError:
+            self._clients.pop(writer, None)
+
+    async def _handle_client(self, reader, writer):
+        """Sends a new viewer the whole layout then handles its control messages until it disconnects"""
+        queue = asyncio.Queue(self._queue_size)
+        self._clients[writer] = queue
+        sender = asyncio.create_task(self._write_queue(writer, queue))
+        try:
+            await self._send_state(writer)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError:
+                    self._send(writer, {'type': 'error', 'message': 'Control messages must be JSON.'})
+                    continue
+                await self._handle_message(writer, message)
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            sender.cancel()
+            writer.close()
+
+    async def _send_state(self, writer):
+        """Sends the whole layout to one viewer"""
+        async with self._sim_lock:
+            state = self._sim.get_state()
+        state['type'] = 'state'
+        state['running'], state['delay'] = self._running, self._auto_run_delay
+        self._send(writer, state)
+
+    async def _handle_message(self, writer, message):
+        """Carries out a control message from a viewer"""
+        action = message.get('action') if isinstance(message, dict) else None
+        if action == 'step':
+            # Same as the spacebar, single steps only happen while auto run is off
+            if not self._running:
+                await self._step()
+        elif action in ('run', 'pause'):
+            self._set_running(action == 'run')
+        elif action == 'speed':
+            try:
+                self._auto_run_delay = clamp(float(message.get('delay')), 0.1, 2)
+            except (TypeError, ValueError):
+                self._send(writer, {'type': 'error', 'message': 'Speed requires a delay in seconds.'})
+                return
+            self._broadcast({'type': 'control', 'running': self._running, 'delay': self._auto_run_delay})
+        elif action in ('add_agent', 'add_wall', 'clear'):
+            try:
+                pos = (int(message['pos'][0]), int(message['pos'][1]))
+            except (KeyError, IndexError, TypeError, ValueError):
+                self._send(writer, {'type': 'error', 'message': f'{action} requires a pos of [x, y].'})
+                return
+            async with self._sim_lock:
+                if not self._sim.edit_cell({'add_agent': 'agent', 'add_wall': 'wall', 'clear': 'clear'}[action], pos):
+                    return
+                cell = self._sim.get_cell_state(pos)
+            cell['type'] = 'edit'
+            self._broadcast(cell)
+        elif action == 'state':
+            await self._send_state(writer)
+        else:
+            self._send(writer, {'type': 'error', 'message': f'Unknown action: {action}'})
@@ -1,5 +1,9 @@
 # General utilities library
 
+# Patient, impatient and neutral, anything storing strategies as indices uses this order
+STRATEGIES = ['p', 'i', 'n']
+
+
 def clamp(n, minn, maxn):
     """Simple function that clamps float between two values"""
     return max(min(maxn, n), minn)